@@ -7,7 +7,7 @@ from torch import nn, ones
 from torchvision import models
 
 from .callbacks import Callback, BatchCallback
-from .model_trainer import ModelTrainer
+from .model_trainer import ModelTrainer, PrefetchLoader, make_loader
 from .resnet_multichannel import Resnet_multichannel, get_arch
 
 
@@ -1,3 +1,6 @@
+import queue
+import threading
+
 import numpy as np
 import torch
 from torch.utils.data import DataLoader
@@ -6,17 +9,103 @@ from .meter import AverageMeter
 from .callbacks import BatchCallback
 
 
+class PrefetchLoader:
+    """
+    Wrap a DataLoader to prefetch its batches in a background thread, so a slow batch(heavy augmentation) does not
+    stall the training loop
+    """
+
+    def __init__(self, loader, max_prefetch=4):
+        self.loader = loader
+        self.max_prefetch = max_prefetch
+
+    def __iter__(self):
+        batches = queue.Queue(self.max_prefetch)
+        stop = threading.Event()
+
+        def prefetch():
+            # items are (batch, None), (None, error) on failure and None at the end
+            try:
+                for batch in self.loader:
+                    batches.put((batch, None))
+                    if stop.is_set():  # don't load the rest of the epoch after an early exit
+                        break
+            except Exception as e:
+                batches.put((None, e))
+            batches.put(None)
+
+        thread = threading.Thread(target=prefetch, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is None:
+                    return
+                batch, error = item
+                if error is not None:
+                    raise error
+                yield batch
+        finally:
+            # on an early exit(break/exception) the thread may be blocked on a full queue, unblock it so it sees the
+            # stop and leaves the DataLoader iterator, which the next epoch resets with persistent workers
+            stop.set()
+            while thread.is_alive():
+                try:
+                    batches.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        # behave like the wrapped DataLoader e.g. .dataset, .batch_size
+        if name == 'loader':
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+
+def make_loader(dataset, batch_size=8, shuffle=False, num_workers=2, pin_memory=True, collate_fn=None,
+                prefetch_factor=4, max_prefetch=4):
+    """
+    Create a DataLoader whose workers persist across epochs, wrapped with PrefetchLoader
+    :param prefetch_factor: number of batches loaded in advance by each worker
+    :param max_prefetch: number of batches queued by the background thread, 0 to return the plain DataLoader
+    :return: PrefetchLoader or DataLoader
+    """
+    kwargs = {}
+    if num_workers > 0:
+        # keep the workers(and their copy of the dataset) alive instead of forking them again every epoch
+        kwargs.update(persistent_workers=True, prefetch_factor=prefetch_factor)
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers,
+                        pin_memory=pin_memory, collate_fn=collate_fn, **kwargs)
+    return PrefetchLoader(loader, max_prefetch) if max_prefetch else loader
+
+
 class ModelTrainer:
-    def __init__(self, model, criterion, optimizer, train_ds, val_ds, device=None, shuffle_valset=False):
+    def __init__(self, model, criterion, optimizer, train_ds, val_ds, device=None, shuffle_valset=False,
+                 collate_fn=None, batch_transforms=None):
+        """
+        :param collate_fn: (optional) collate_fn for the DataLoaders e.g. thyroid_collate
+        :param batch_transforms: (optional) dictionary that maps phase('train'/'val') to a module applied to the
+        input batch once it is on the device e.g. { 'train': GPUTransform(224, 'train'), 'val': GPUTransform(224, 'val') }
+        """
         self.model = model
         self.criterion = criterion
         self.optimizer = optimizer
+        self.collate_fn = collate_fn
         # Use dataset to create dataloader
         self.dataloaders = {
-            "train": DataLoader(train_ds, batch_size=8, shuffle=True, num_workers=2, pin_memory=True),
-            "val": DataLoader(val_ds, batch_size=16, shuffle=shuffle_valset, num_workers=2, pin_memory=True)
+            "train": make_loader(train_ds, batch_size=8, shuffle=True, num_workers=2, pin_memory=True,
+                                 collate_fn=collate_fn),
+            "val": make_loader(val_ds, batch_size=16, shuffle=shuffle_valset, num_workers=2, pin_memory=True,
+                               collate_fn=collate_fn)
         }
         self.device = device
+        self.batch_transforms = batch_transforms or {}
+        if device:
+            for transform in self.batch_transforms.values():
+                transform.to(device)
         self.best_val_loss = np.inf
         self.best_epoch = 0
 
@@ -65,6 +154,14 @@ class ModelTrainer:
             acc = corrects / inputs.shape[0]
             return loss.item(), acc.item(), preds, labels, "val"
 
+    def to_device(self, inputs):
+        # a list of encoded JPEGs is left on the CPU, the batch transform decodes it on the device
+        return inputs.to(self.device, non_blocking=True) if torch.is_tensor(inputs) else inputs
+
+    def transform_batch(self, inputs, phase):
+        transform = self.batch_transforms.get(phase)
+        return transform(inputs) if transform is not None else inputs
+
     def train_epoch(self, callback=None):
         # Set model to be in training mode
         self.model.train()
@@ -72,11 +169,12 @@ class ModelTrainer:
         loss_meter = AverageMeter('train_loss')
         acc_meter = AverageMeter('train_acc', fmt=':.2f')
 
-        for inputs, labels, extra in self.dataloaders["train"]:
+        for inputs, labels, *extra in self.dataloaders["train"]:
             # move inputs and labels to target device (GPU/CPU/TPU)
             if self.device:
-                inputs = inputs.to(self.device)
-                labels = labels.to(self.device)
+                inputs = self.to_device(inputs)
+                labels = labels.to(self.device, non_blocking=True)
+            inputs = self.transform_batch(inputs, "train")
 
             callback and callback.on_batch_start()
             loss, acc, preds, labels, phase = self.train_one_batch(inputs, labels)
@@ -100,11 +198,12 @@ class ModelTrainer:
         acc_meter = AverageMeter('val_acc', fmt=':.2f')
 
         with torch.no_grad():
-            for inputs, labels, extra in val_loader:
+            for inputs, labels, *extra in val_loader:
                 # move inputs and labels to target device (GPU/CPU/TPU)
                 if self.device:
-                    inputs = inputs.to(self.device)
-                    labels = labels.to(self.device)
+                    inputs = self.to_device(inputs)
+                    labels = labels.to(self.device, non_blocking=True)
+                inputs = self.transform_batch(inputs, "val")
 
                 callback and callback.on_batch_start()
                 loss, acc, preds, labels, phase = self.val_one_batch(inputs, labels)
@@ -140,7 +239,8 @@ class ModelTrainer:
             #print()
 
     def eval(self, ext_val_ds, batch_size=16, shuffle=True):
-        ext_val = DataLoader(ext_val_ds, batch_size=batch_size, shuffle=shuffle, num_workers=2, pin_memory=True)
+        ext_val = DataLoader(ext_val_ds, batch_size=batch_size, shuffle=shuffle, num_workers=2, pin_memory=True,
+                             collate_fn=self.collate_fn)
         val_loss, val_acc = self.val_epoch(val_loader=ext_val)
 
         return (val_loss, val_acc)
@@ -1,24 +1,89 @@
 import os
+import functools
+import torch
 import torchvision.transforms as transforms
 import glob
-from torchvision.transforms.functional import InterpolationMode
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict
 
 # imagenet mean and std
 imagenet_mean = [0.485, 0.456, 0.406]
 imagenet_std = [0.229, 0.224, 0.225]
 
-from .thyroid import ThyroidDataset
+# imagenet mean and std shaped (1, 3, 1, 1) to broadcast over a batch of [B, 3, H, W]
+IMAGENET_MEAN = torch.tensor(imagenet_mean, dtype=torch.float32).view(1, 3, 1, 1)
+IMAGENET_STD = torch.tensor(imagenet_std, dtype=torch.float32).view(1, 3, 1, 1)
+
+
+@functools.lru_cache(maxsize=None)
+def get_imagenet_mean_std(device, dtype=torch.float32):
+    """
+    IMAGENET_MEAN and IMAGENET_STD on the given device and dtype, they are copied once and reused for every batch
+    :param device: torch.device
+    :param dtype: torch dtype
+    :return: mean, std
+    """
+    return IMAGENET_MEAN.to(device=device, dtype=dtype), IMAGENET_STD.to(device=device, dtype=dtype)
+
+
+def normalize_inplace(x, mean=None, std=None, dtype=None):
+    """
+    Normalize a float batch of [B, C, H, W] in-place, on its device
+    :param x: the batch
+    :param mean: (optional) per-channel mean shaped (1, C, 1, 1) on the batch device, default is the ImageNet mean
+    for a batch in [0, 1]
+    :param std: (optional) per-channel std shaped (1, C, 1, 1) on the batch device, default is the ImageNet std
+    :param dtype: (optional) convert the batch first e.g. torch.bfloat16 to halve the memory traffic on Ampere+
+    :return: the normalized batch, x itself unless it is converted to dtype
+    """
+    if dtype is not None and x.dtype != dtype:
+        x = x.to(dtype)
+    if mean is None or std is None:
+        mean, std = get_imagenet_mean_std(x.device, x.dtype)
+    return x.sub_(mean).div_(std)
+
+
+def enlarged_size(target_size):
+    """
+    Size of the image before it is cropped to target_size, 10% bigger for the later cropping
+    :param target_size: tuple of (W,H) or int if square
+    :return: tuple of the enlarged size
+    """
+    if type(target_size) is int:
+        size = int(target_size * 1.1)
+        return size, size
+    return int(target_size[0] * 1.1), int(target_size[1] * 1.1)
+
+
+from .thyroid import ThyroidDataset, ThyroidBatch, thyroid_collate
+from .augment import GPUTransform, BatchNormalize, RandomRotatedCrop, DecodeJPEG
+
+
+# ImageNet normalizer
+imagenet_normalize = transforms.Normalize(mean=imagenet_mean, std=imagenet_std)
+
+
+@functools.lru_cache(maxsize=None)
+def get_enlarge_transform(target_size):
+    """
+    The Resize to enlarged_size(target_size), shared by every pipe of the same target_size
+    :param target_size: tuple of (W,H) or int if square
+    :return: transforms.Resize
+    """
+    return transforms.Resize(size=enlarged_size(target_size))
 
 
 ####################################################################
 # transform in dataset to target size
 ####################################################################
-def get_transform(target_size, phase='train'):
+@functools.lru_cache(maxsize=None)
+def get_transform(target_size, phase='train', on_gpu=False):
     """
-    Predefined transformation pipe for the dataset
+    Predefined transformation pipe for the dataset, the pipe is built once and shared for the same arguments
     :param target_size: tuple of (W,H) result image from the pipe
     :param phase: train/val/test phase of different transformation e.g. test will not need RandomCrop
+    :param on_gpu: if True, the pipe only resizes(and crops for val/test) and returns a uint8 tensor,
+    the augmentation and normalization are left to GPUTransform on the batch
     :return: a transformation function to target_size
     """
     if type(target_size) is int:
@@ -27,43 +92,37 @@ def get_transform(target_size, phase='train'):
     assert type(target_size) is tuple, "target_size must be tuple of (W:int, H:int) or int if square is needed"
 
     # enlarge 10% bigger for the later cropping
-    enlarge = transforms.Resize(size=(int(target_size[0] * 1.1), int(target_size[1] * 1.1)))
-
-    # ImageNet normalizer
-    imagenet_normalize = transforms.Normalize(mean=imagenet_mean, std=imagenet_std)
-
-    transform_dict = {
-        'train':
-            transforms.Compose([
-                enlarge,
-                transforms.RandomRotation(45, interpolation=InterpolationMode.BILINEAR, expand=True),
-                transforms.CenterCrop(target_size),
-                transforms.RandomHorizontalFlip(0.5),
-                transforms.RandomPerspective(0.2),
-                transforms.RandomApply([
-                    transforms.ColorJitter(brightness=0.126, contrast=0.2)
-                ], p=0.5),
-                transforms.ToTensor(),
-                imagenet_normalize
-            ]),
-        'val':
-            transforms.Compose([
-                enlarge,
-                transforms.CenterCrop(target_size),
-                transforms.ToTensor(),
-                imagenet_normalize
-            ]),
-        'test':
-            transforms.Compose([
-                enlarge,
-                transforms.CenterCrop(target_size),
-                transforms.ToTensor(),
-                imagenet_normalize
-            ])
-    }
-
-    if phase in transform_dict:
-        return transform_dict[phase]
+    # (a pre-resized image of `python -m digitake.preprocess.precompute` is already this size, so Resize only copies it)
+    enlarge = get_enlarge_transform(target_size)
+
+    if on_gpu:
+        if phase == 'train':
+            return transforms.Compose([enlarge, transforms.PILToTensor()])
+        elif phase in ('val', 'test'):
+            return transforms.Compose([enlarge, transforms.CenterCrop(target_size), transforms.PILToTensor()])
+        else:
+            raise Exception("Unknown phase specified")
+
+    if phase == 'train':
+        return transforms.Compose([
+            enlarge,
+            # RandomRotation(45, expand=True) + CenterCrop(target_size) in one resample
+            RandomRotatedCrop(45, target_size),
+            transforms.RandomHorizontalFlip(0.5),
+            transforms.RandomPerspective(0.2),
+            transforms.RandomApply([
+                transforms.ColorJitter(brightness=0.126, contrast=0.2)
+            ], p=0.5),
+            transforms.ToTensor(),
+            imagenet_normalize
+        ])
+    elif phase in ('val', 'test'):
+        return transforms.Compose([
+            enlarge,
+            transforms.CenterCrop(target_size),
+            transforms.ToTensor(),
+            imagenet_normalize
+        ])
     else:
         raise Exception("Unknown phase specified")
 
@@ -86,17 +145,37 @@ def build_dataset(datasource: Dict[str, str], root="", ext="*.png"):
     :param ext: the file extension to search for
     :return: a dictionary of data split by corresponding label name e.g. { 'benign', 'malignant'}
     """
-    datasets = {}
-    for key in datasource:
-        if isinstance(datasource[key], list):
-            files = []
-            for path in datasource[key]:
-                files += glob.glob(os.path.join(root, path, ext))
-            datasets[key] = files
-        else:
-            datasets[key] = glob.glob(os.path.join(root, datasource[key], ext))
+    def search(key):
+        paths = datasource[key] if isinstance(datasource[key], list) else [datasource[key]]
+        files = []
+        for path in paths:
+            files += find_files(os.path.join(root, path), ext)
+        return key, files
+
+    # directory listing is latency bound(especially on network storage), so list each class concurrently
+    with ThreadPoolExecutor(max_workers=max(len(datasource), 1)) as executor:
+        return dict(executor.map(search, datasource))
 
-    return datasets
+
+def find_files(directory, ext="*.png"):
+    """
+    Same as glob.glob(os.path.join(directory, ext)), but a plain "*<suffix>" pattern is matched with os.scandir
+    and str.endswith instead of fnmatch on every entry
+    :param directory: the directory to search in
+    :param ext: the file extension(glob pattern) to search for
+    :return: list of matched paths
+    """
+    suffix = ext[1:]
+    if not ext.startswith('*') or glob.has_magic(suffix) or glob.has_magic(directory):
+        return glob.glob(os.path.join(directory, ext))
+
+    try:
+        with os.scandir(directory or os.curdir) as entries:
+            # like glob, hidden files are not matched by '*'
+            return [os.path.join(directory, e.name) for e in entries
+                    if e.name.endswith(suffix) and not e.name.startswith('.')]
+    except OSError:  # glob returns nothing for a missing/unreadable directory
+        return []
 
 
 def explain_dataset(ds):
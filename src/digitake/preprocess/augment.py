@@ -0,0 +1,162 @@
+import math
+
+import torch
+import torchvision
+import torchvision.transforms.functional as F
+from PIL import Image
+from torch import nn
+from torchvision.io import ImageReadMode
+
+from . import IMAGENET_MEAN, IMAGENET_STD, enlarged_size, normalize_inplace
+
+# kornia is optional, it is only needed for the GPU train augmentation
+try:
+    import kornia.augmentation as K
+except ImportError:
+    K = None
+
+
+class GPUTransform(nn.Module):
+    """
+    Batched counterpart of get_transform(on_gpu=False), to be used with get_transform(on_gpu=True).
+    It takes a uint8 batch of [B, C, H, W] that is already on the device, so the augmentation runs as batched kernels
+    instead of per-sample PIL operations in the DataLoader workers.
+    """
+
+    def __init__(self, target_size, phase='train'):
+        """
+        :param target_size: tuple of (W,H) result image from the pipe
+        :param phase: train/val/test phase, only train is augmented (val/test are already cropped by the CPU pipe)
+        """
+        super().__init__()
+        if type(target_size) is int:
+            target_size = (target_size, target_size)
+
+        if phase == 'train':
+            assert K is not None, "kornia is required for GPU augmentation, pip install kornia"
+            self.augment = nn.Sequential(
+                # rotating about the center then cropping gives the same result as RandomRotation(expand=True)
+                K.RandomRotation(45.0, p=1.0),
+                K.CenterCrop(target_size),
+                K.RandomHorizontalFlip(p=0.5),
+                K.RandomPerspective(0.2, p=0.5),
+                K.ColorJitter(brightness=0.126, contrast=0.2, p=0.5)
+            )
+        elif phase in ('val', 'test'):
+            self.augment = None
+        else:
+            raise Exception("Unknown phase specified")
+
+        self.normalize = BatchNormalize()
+
+    def forward(self, x):
+        if self.augment is not None:
+            x = self.augment(x.float().div_(255))  # kornia augmentation works on [0, 1]
+            return normalize_inplace(x)  # the augmented batch is our own, normalize it in place
+        return self.normalize(x)
+
+
+class DecodeJPEG(nn.Module):
+    """
+    GPU counterpart of get_transform(on_gpu=True) for ThyroidDataset(decode_on_gpu=True). It decodes a list of encoded
+    JPEGs with nvjpeg on the device, resizes(and crops for val/test) them and stacks into a uint8 batch of
+    [B, 3, H, W] for GPUTransform e.g. nn.Sequential(DecodeJPEG(224, 'train'), GPUTransform(224, 'train'))
+    """
+
+    def __init__(self, target_size, phase='train', device='cuda'):
+        """
+        :param target_size: tuple of (W,H) result image from the pipe
+        :param phase: train/val/test phase, val/test are center cropped to target_size
+        :param device: the device to decode on
+        """
+        super().__init__()
+        if type(target_size) is int:
+            target_size = (target_size, target_size)
+        if phase not in ('train', 'val', 'test'):
+            raise Exception("Unknown phase specified")
+
+        # same as the `enlarge` of get_transform
+        self.enlarged_size = enlarged_size(target_size)
+        self.crop_size = target_size if phase in ('val', 'test') else None
+        self.device = device
+
+    def forward(self, data):
+        images = []
+        for encoded in data:
+            image = torchvision.io.decode_jpeg(encoded, mode=ImageReadMode.RGB, device=self.device)
+            # tensors are not antialiased by default, unlike the PIL Resize of the CPU pipes
+            image = F.resize(image, self.enlarged_size, antialias=True)
+            if self.crop_size:
+                image = F.center_crop(image, self.crop_size)
+            images.append(image)
+        return torch.stack(images)
+
+
+class BatchNormalize(nn.Module):
+    """
+    Normalize a batch of [B, C, H, W] on its device. A uint8 batch is scaled from [0, 255] by the same pass,
+    so ToTensor() and Normalize() become a single cast, sub and div over the batch
+    """
+
+    def __init__(self, mean=IMAGENET_MEAN, std=IMAGENET_STD, dtype=torch.float32):
+        """
+        :param mean: sequence or tensor of per-channel mean
+        :param std: sequence or tensor of per-channel std
+        :param dtype: dtype of the normalized batch e.g. torch.bfloat16 to halve the memory traffic on Ampere+
+        """
+        super().__init__()
+        self.dtype = dtype
+        # clone, so the buffers(and load_state_dict into them) never share memory with IMAGENET_MEAN/IMAGENET_STD
+        mean = torch.as_tensor(mean, dtype=torch.float32).clone().view(1, -1, 1, 1)
+        std = torch.as_tensor(std, dtype=torch.float32).clone().view(1, -1, 1, 1)
+        self.register_buffer('mean', mean.to(dtype))
+        self.register_buffer('std', std.to(dtype))
+        # mean/std for the [0, 255] range of uint8 input, scaled in float32 before the cast(e.g. 0.485 * 255 in bf16)
+        self.register_buffer('mean_255', (mean * 255).to(dtype))
+        self.register_buffer('std_255', (std * 255).to(dtype))
+
+    def forward(self, x):
+        if x.is_floating_point():
+            return normalize_inplace(x.to(self.dtype, copy=True), self.mean, self.std)
+        return normalize_inplace(x.to(self.dtype), self.mean_255, self.std_255)
+
+
+class RandomRotatedCrop:
+    """
+    RandomRotation(degrees, expand=True) followed by CenterCrop(size) on a PIL image, done as a single affine resample
+    straight into the cropped size, instead of rotating into an expanded canvas and cropping it afterward.
+    The result is the same up to the sub-pixel rounding of the expanded canvas center.
+    """
+
+    def __init__(self, degrees, size, resample=Image.BILINEAR, fill=0):
+        """
+        :param degrees: range of degrees to select from (-degrees, +degrees)
+        :param size: (h, w) of the crop as in CenterCrop, or int if square
+        :param resample: PIL resampling filter
+        :param fill: pixel fill value for the area outside the rotated image
+        """
+        self.degrees = degrees
+        self.size = (size, size) if type(size) is int else size
+        self.resample = resample
+        self.fill = fill
+
+    def __call__(self, img):
+        # same random source as torchvision's RandomRotation, so set_reproducible still applies
+        angle = float(torch.empty(1).uniform_(-self.degrees, self.degrees).item())
+
+        # inverse mapping from an output pixel to the input, rotating about the centers of both images
+        # (the same matrix as PIL's Image.rotate, with the output center moved to the crop center)
+        theta = -math.radians(angle)
+        a, b = math.cos(theta), math.sin(theta)
+        d, e = -math.sin(theta), math.cos(theta)
+        out_w, out_h = self.size[1], self.size[0]
+        in_w, in_h = img.size
+        c = a * (-out_w / 2) + b * (-out_h / 2) + in_w / 2
+        f = d * (-out_w / 2) + e * (-out_h / 2) + in_h / 2
+
+        return img.transform((out_w, out_h), Image.AFFINE, (a, b, c, d, e, f), resample=self.resample,
+                             fillcolor=self.fill)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(degrees={self.degrees}, size={self.size})"
+
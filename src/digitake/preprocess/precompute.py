@@ -0,0 +1,79 @@
+"""
+Pre-resize the dataset images to the enlarged size of get_transform and store them as WebP, so the workers read
+smaller files and don't resize every epoch. Use the output directory and target size as
+ThyroidDataset(precomputed_dir=..., precomputed_size=...)
+
+e.g. python -m digitake.preprocess.precompute --out cache/224 --target-size 224x224 --root data \
+        Malignant_Markers_Crop Benign_Markers_Crop
+"""
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from . import enlarged_size, find_files
+from .thyroid import load_rgb_image, precomputed_path
+
+
+def parse_size(size):
+    """
+    :param size: "HxW" or "S" for square
+    :return: tuple of (H, W) or int
+    """
+    if 'x' in size:
+        h, w = size.split('x')
+        return int(h), int(w)
+    return int(size)
+
+
+def precompute_image(path, out, target_size, quality=None):
+    """
+    Resize one image to enlarged_size(target_size) and save it into out
+    :param path: path to the original image
+    :param out: the output directory
+    :param target_size: tuple of (W,H) or int, the same target_size given to get_transform
+    :param quality: WebP quality, None for lossless
+    :return: path to the pre-resized image
+    """
+    output_path = precomputed_path(out, path, target_size)
+    if os.path.exists(output_path):
+        return output_path
+
+    # Resize of get_transform takes its size as (h, w)
+    h, w = enlarged_size(target_size)
+    image = load_rgb_image(path).resize((w, h), Image.BILINEAR)
+
+    # write to a temporary file then rename, so an interrupted run never leaves a partial image
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    if quality is None:
+        image.save(tmp_path, format='WEBP', lossless=True)
+    else:
+        image.save(tmp_path, format='WEBP', quality=quality)
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help='directories of the images, relative to --root')
+    parser.add_argument('--out', required=True, help='output directory')
+    parser.add_argument('--target-size', required=True, type=parse_size, help='HxW or S, target_size of get_transform')
+    parser.add_argument('--root', default='', help='the root path to be prepended to paths')
+    parser.add_argument('--ext', default='*.png', help='the file extension to search for')
+    parser.add_argument('--quality', type=int, default=None, help='WebP quality, default is lossless')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of threads')
+    args = parser.parse_args(args)
+
+    os.makedirs(args.out, exist_ok=True)
+    files = [file for path in args.paths for file in find_files(os.path.join(args.root, path), args.ext)]
+
+    # PIL releases the GIL while decoding/resizing/encoding, so threads are enough
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for _ in executor.map(lambda file: precompute_image(file, args.out, args.target_size, args.quality), files):
+            pass
+    print(f"Precomputed {len(files)} images to {args.out}")
+
+
+if __name__ == '__main__':
+    main()
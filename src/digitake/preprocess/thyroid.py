@@ -1,14 +1,145 @@
+import hashlib
+import io
+import itertools
+import os
+import warnings
+
+import numpy as np
+import torch
+import torchvision
 from PIL import Image
 from torch.utils.data import Dataset
+from torch.utils.data.dataloader import default_collate
 from torch.utils.data.dataset import T_co
 
+from . import enlarged_size
+
+# libjpeg-turbo is optional, when it is not installed(or the shared library can't be found) we fall back to Pillow
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _turbo_jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    _turbo_jpeg = None
+
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+
+# phases whose transformation is deterministic, so the transformed image can be cached
+CACHEABLE_PHASES = ('val', 'test')
+
+
+def read_file(path):
+    """
+    Read the whole file with one read into memory, instead of the many small reads PIL makes while parsing the header
+    and decoding, which are costly on high latency storage e.g. NFS
+    :param path: path to the file
+    :return: bytes of the file
+    """
+    fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)  # hint the kernel to read ahead
+        size = os.fstat(fd).st_size
+        chunks = []
+        while size > 0:  # a single read may return less than requested
+            chunk = os.read(fd, size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+    finally:
+        os.close(fd)
+
+
+def load_rgb_image(path):
+    """
+    Load an image as RGB, JPEG files are decoded with libjpeg-turbo(SIMD) when PyTurboJPEG is available
+    :param path: path to the image file
+    :return: PIL Image in RGB mode
+    """
+    if _turbo_jpeg is not None and os.path.splitext(path)[1].lower() in JPEG_EXTENSIONS:
+        # decode straight into a HxWx3 uint8 RGB array
+        return Image.fromarray(_turbo_jpeg.decode(read_file(path), pixel_format=TJPF_RGB))
+
+    image = Image.open(io.BytesIO(read_file(path)))
+    # convert() always copies, most JPEGs are already decoded as RGB
+    return image if image.mode == 'RGB' else image.convert('RGB')
+
+
+def precomputed_path(directory, path, target_size):
+    """
+    Path of the pre-resized copy of an image made by `python -m digitake.preprocess.precompute`
+    :param directory: the output directory of precompute
+    :param path: path to the original image
+    :param target_size: tuple of (W,H) or int, the target_size given to precompute
+    :return: path to the pre-resized image in directory
+    """
+    # realpath, so the same file is found whatever cwd or root form it is given with, and the size is in the name,
+    # so a copy resized for another target_size is never picked up
+    key = hashlib.sha1(os.path.realpath(path).encode()).hexdigest()
+    h, w = enlarged_size(target_size)
+    return os.path.join(directory, f"{key}_{h}x{w}.webp")
+
+
+def flatten_dataset(dataset):
+    """
+    Flatten the dataset into parallel arrays ordered by the sorted label, this order is the linear index of
+    ThyroidDataset
+    :param dataset: dictionary of label to list of paths
+    :return: label_names, paths, class_indices
+    """
+    label_names = tuple(sorted(dataset))
+    paths = [path for k in label_names for path in dataset[k]]
+    # a handful of classes, int8 keeps the array small and cheap to slice for a batch
+    dtype = np.int8 if len(label_names) <= np.iinfo(np.int8).max + 1 else np.int64
+    class_indices = np.repeat(np.arange(len(label_names), dtype=dtype), [len(dataset[k]) for k in label_names])
+    return label_names, paths, class_indices
+
+
+class ThyroidBatch:
+    """
+    A batch of ThyroidDataset items, it implements pin_memory() so DataLoader(pin_memory=True) pins the image
+    and label tensors and they can be sent to GPU with non_blocking=True
+    """
+    __slots__ = ('image', 'label', 'extra')
+
+    def __init__(self, image, label, extra):
+        self.image = image
+        self.label = label
+        self.extra = extra
+
+    def pin_memory(self):
+        if torch.is_tensor(self.image):  # encoded JPEGs(decode_on_gpu) stay as a list for the CPU side of nvjpeg
+            self.image = self.image.pin_memory()
+        self.label = self.label.pin_memory()
+        return self
+
+    def __iter__(self):
+        # unpack like the default (image, label, extra) batch
+        return iter((self.image, self.label, self.extra))
+
+
+def thyroid_collate(batch):
+    """
+    collate_fn for ThyroidDataset e.g. DataLoader(ds, pin_memory=True, collate_fn=thyroid_collate)
+    :param batch: list of (image, class_index) or (image, class_index, extra) from ThyroidDataset
+    :return: ThyroidBatch, its image is a list of encoded JPEGs if the dataset is decode_on_gpu and its extra is None
+    if the dataset doesn't return_extra
+    """
+    images, labels, *extras = zip(*batch)
+    # encoded JPEGs are 1-D and of different lengths, they can't be stacked before decoding
+    images = torch.stack(images) if images[0].dim() > 1 else list(images)
+    return ThyroidBatch(images, torch.tensor(labels), default_collate(extras[0]) if extras else None)
+
 
 class ThyroidDataset(Dataset):
     """
     Dataset for Thyroid Image
     """
 
-    def __init__(self, phase, dataset, transform, mask_dict=None, with_alpha_channel=True):
+    def __init__(self, phase, dataset, transform, mask_dict=None, with_alpha_channel=True, cache_dir=None,
+                 image_cache=None, decode_on_gpu=False, return_extra=None, precomputed_dir=None,
+                 cache_key=None, precomputed_size=None):
         """
 
         :param phase: Train/Validation/Test phase
@@ -16,59 +147,144 @@ class ThyroidDataset(Dataset):
         :param transform: the transform function
         :param mask_dict: (optional) dictionary that map from a given path in the dataset to mask path
         :param with_alpha_channel: (optional) if False, it will load image as RGB(3-channel)
+        :param cache_dir: (optional) directory to keep the transformed images of val/test phase, so the image is
+        decoded and transformed only once. The transform must be deterministic for that phase.
+        :param image_cache: (optional) the .npy file made by ThyroidDataset.prepare_cache for this dataset, images are
+        read from it instead of decoding the image files
+        :param decode_on_gpu: (optional) if True, return the encoded JPEG bytes as a uint8 tensor instead of the
+        transformed image, to be decoded with nvjpeg by DecodeJPEG. It needs collate_fn=thyroid_collate and RGB images,
+        the transform is not applied.
+        :param return_extra: (optional) if True, items are (image, class_index, extra) otherwise (image, class_index).
+        Default is False for train phase(extra is not used in training) and True for the others
+        :param precomputed_dir: (optional) the output directory of `python -m digitake.preprocess.precompute`, the
+        pre-resized images are loaded instead of the originals(an image that isn't precomputed uses its original)
+        :param cache_key: (optional) identifies the transform in the cache_dir keys, change it when the transform
+        changes. Default is repr(transform), which must then identify it(e.g. no lambda, function or transforms.Lambda)
+        :param precomputed_size: (optional) the --target-size given to precompute, required with precomputed_dir
         """
         assert phase is not None
         assert dataset is not None
         assert transform is not None
+        assert not precomputed_dir or precomputed_size is not None, "precomputed_dir needs precomputed_size"
         self.phase = phase
-        self.dataset = dataset
-        self.partition = [(k, len(v)) for k, v in sorted(self.dataset.items())]
+        self.precomputed_dir = precomputed_dir
+        self.precomputed_size = precomputed_size
+        self.image_cache = image_cache
+        self._image_cache = None  # opened lazily, so each DataLoader worker maps the file after fork
+        self.set_dataset(dataset)
         self.transform = transform
         self.mask_dict = mask_dict if mask_dict is not None and type(mask_dict) == dict else {}
         self.extra_channel_default = None
         self.with_alpha_channel = with_alpha_channel
+        self.return_extra = return_extra if return_extra is not None else phase != 'train'
+        self.cache_dir = cache_dir if phase in CACHEABLE_PHASES else None
+        self.cache_key = cache_key if cache_key is not None else repr(transform)
+        if self.cache_dir:
+            # a repr with the memory address changes every run, so the cache would never hit and grow forever, and
+            # Lambda() says nothing about its function, so different pipes would serve each other's images
+            assert ' at 0x' not in self.cache_key and 'Lambda(' not in self.cache_key, \
+                "repr(transform) doesn't identify the transform, specify cache_key"
+            os.makedirs(self.cache_dir, exist_ok=True)
+        self.decode_on_gpu = decode_on_gpu
+        assert not (decode_on_gpu and with_alpha_channel), "decode_on_gpu only supports RGB(with_alpha_channel=False)"
+
+    @classmethod
+    def prepare_cache(cls, dataset, cache_path, target_size):
+        """
+        Decode every image of the dataset, resize it to the enlarged size of get_transform and pack them into a single
+        memory-mapped uint8 file of [N, H, W, 3], so later epochs only slice the file instead of decoding and resizing.
+        The class indices and paths are saved next to it as <cache_path>_labels.npy and <cache_path>_paths.npy
+        :param dataset: the dataset(in form of path) to be given to ThyroidDataset
+        :param cache_path: the .npy file to be written
+        :param target_size: tuple of (W,H) or int, the same target_size given to get_transform
+        :return: cache_path
+        """
+        # same size as the `enlarge` of get_transform, Resize takes its size as (h, w)
+        h, w = enlarged_size(target_size)
+
+        _, paths, class_indices = flatten_dataset(dataset)
+        images = np.lib.format.open_memmap(cache_path, mode='w+', dtype=np.uint8, shape=(len(paths), h, w, 3))
+        for i, path in enumerate(paths):
+            images[i] = np.asarray(load_rgb_image(path).resize((w, h), Image.BILINEAR))
+        images.flush()
+        np.save(cls.__get_labels_path(cache_path), class_indices)
+        np.save(cls.__get_paths_path(cache_path), np.array(paths, dtype=str))
+        return cache_path
+
+    @staticmethod
+    def __get_labels_path(cache_path):
+        return f"{os.path.splitext(cache_path)[0]}_labels.npy"
+
+    @staticmethod
+    def __get_paths_path(cache_path):
+        return f"{os.path.splitext(cache_path)[0]}_paths.npy"
+
+    def __check_image_cache(self):
+        # the cache is sliced by linear index, so it must hold exactly these paths in this order
+        cached_class_indices = np.load(self.__get_labels_path(self.image_cache))
+        cached_paths = np.load(self.__get_paths_path(self.image_cache))
+        assert np.array_equal(cached_class_indices, self._class_indices) and cached_paths.tolist() == self._paths, \
+            f"{self.image_cache} is not prepared from this dataset"
 
     def set_dataset(self, dataset):
+        """
+        Set the dataset(in form of path) and flatten it, call it again after changing the dataset in place
+        :param dataset: dictionary of label to list of paths
+        """
         self.dataset = dataset
-        self.partition = [(k, len(v)) for k, v in sorted(self.dataset.items())]  # Create a partition indices
+        # flatten into parallel arrays indexed by the linear index, so __getitem__ needs no partition lookup
+        self._label_names, self._paths, self._class_indices = flatten_dataset(self.dataset)
+        self.partition = [(k, len(self.dataset[k])) for k in self._label_names]  # Create a partition indices
+        # start offset of each partition, to get the index within its class
+        self._offsets = [0] + list(itertools.accumulate(v for _, v in self.partition))[:-1]
+        # the files to be decoded, the original paths are kept for extra and mask lookup
+        self._sources = self._paths
+        if self.precomputed_dir:
+            self._sources = [self.__find_precomputed(path) for path in self._paths]
+            missing = sum(source is path for source, path in zip(self._sources, self._paths))
+            if missing:
+                warnings.warn(f"{missing} of {len(self._paths)} images are not precomputed in {self.precomputed_dir} "
+                              f"for size {self.precomputed_size}, their originals are used")
+        if self.image_cache:
+            self.__check_image_cache()
 
     def __len__(self):
-        size = len(sum(self.dataset.values(), []))  # monoid flatten, it's counting item so order doesn't matter
-        return size
-
-    def __get_partitioned_index(self, index):
-        if index < 0:
-            raise IndexError(f"Index must not be negative")
-
-        class_num = 0
-        for (k, v) in self.partition:
-            if index >= v:
-                index -= v
-                class_num += 1
-            else:
-                return k, class_num, index
-        raise IndexError(f"Index is out of range {index}")
+        return len(self._paths)
 
     def __getitem__(self, index) -> T_co:
         """
         __getitem__ takes index of linear data, meaning that the label key will be used to keep track of partition
         :param index: linear index
-        :return: image, label, extra
+        :return: image, class_index, extra(only if return_extra)
         """
-        # convert linear index into index respecting its partition
-        # e.g. [0,1,2,3,4,5,6,7,8] --> [0,1,2,3,0,1,2,3,4]
-        label, class_index, index = self.__get_partitioned_index(index)
-        path = self.dataset[label][index]
+        if index < 0:
+            raise IndexError(f"Index must not be negative")
+        if index >= len(self._paths):
+            raise IndexError(f"Index is out of range {index}")
+
+        path = self._paths[index]
+        class_index = int(self._class_indices[index])
+        label = self._label_names[class_index]
+
+        image = self.__get_image(index, path, label)
+
+        if not self.return_extra:
+            return image, class_index
 
         extra = {
             'path': path,
             'label': label,
             'class_index': class_index,
-            'inclass_index': index
+            # index respecting its partition e.g. [0,1,2,3,4,5,6,7,8] --> [0,1,2,3,0,1,2,3,4]
+            'inclass_index': index - self._offsets[class_index]
         }
 
-        # load and transform
-        image = Image.open(path).convert('RGB')
+        # return image, label and extra
+        return image, class_index, extra
+
+    def __get_image(self, index, path, label):
+        if self.decode_on_gpu:
+            return torchvision.io.read_file(path)
 
         try:
             extracted_filename = path.split('/')[-1]  # extract the filename of image to find its counterpart
@@ -78,28 +294,64 @@ class ThyroidDataset(Dataset):
         except KeyError:
             mask_path = None
 
+        cache_path = self.__get_cache_path(self._sources[index], mask_path)
+        if cache_path and os.path.exists(cache_path):
+            return torch.from_numpy(np.load(cache_path))
+
+        # load and transform
+        if self.image_cache:
+            if self._image_cache is None:
+                self._image_cache = np.load(self.image_cache, mmap_mode='r')
+            image = Image.fromarray(self._image_cache[index])
+        else:
+            image = load_rgb_image(self._sources[index])
+
         if self.with_alpha_channel:
             # if it has mask, find the mask path pair and load
             if mask_path:
                 # Gray scale image(this could actually be just B/W Image(0/1)
-                mask_image = Image.open(mask_path).convert('L')
+                mask_image = Image.open(io.BytesIO(read_file(mask_path)))
+                if mask_image.mode != 'L':
+                    mask_image = mask_image.convert('L')
+                if mask_image.size != image.size:  # the cached image is already resized
+                    mask_image = mask_image.resize(image.size, Image.BILINEAR)
                 r, g, b = image.split()
                 image = Image.merge('RGBA', (r, g, b, mask_image))
             else:
-                gray_image = Image.open(path).convert('L')
+                gray_image = image.convert('L')
                 if self.extra_channel_default and type(self.extra_channel_default) == int:
                     gray_image.point(lambda _i: self.extra_channel_default)
                 r, g, b = image.split()
                 image = Image.merge('RGBA', (r, g, b, gray_image))
-        else:
-            # load and transform
-            image = Image.open(path).convert('RGB')
 
         transformed_image = self.transform(image)
 
-        # return image and label
-        return transformed_image, class_index, extra
+        if cache_path:
+            self.__save_cache(cache_path, transformed_image)
+
+        return transformed_image
+
+    def __find_precomputed(self, path):
+        precomputed = precomputed_path(self.precomputed_dir, path, self.precomputed_size)
+        return precomputed if os.path.exists(precomputed) else path
+
+    def __get_cache_path(self, source, mask_path):
+        if not self.cache_dir:
+            return None
+
+        # source is the file actually decoded(e.g. the precomputed copy), and the transform repr carries its parameters
+        # e.g. Resize/CenterCrop size, so changing either of them invalidates the cache
+        key = hashlib.sha1(f"{source}|{mask_path}|{self.with_alpha_channel}|{self.cache_key}".encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    @staticmethod
+    def __save_cache(cache_path, transformed_image):
+        # write to a temporary file then rename, so other workers never read a partially written file
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, transformed_image.numpy())
+        os.replace(tmp_path, cache_path)
 
     def get_class_label(self, class_index):
-        assert class_index < len(self.partition), 'The class_index is beyond number of class available'
-        return self.partition[class_index][0]
+        assert class_index < len(self._label_names), 'The class_index is beyond number of class available'
+        return self._label_names[class_index]
@@ -0,0 +1,32 @@
+import pytest
+import torch
+from torch.utils.data import Dataset, TensorDataset
+
+from src.digitake.model.model_trainer import PrefetchLoader, make_loader
+
+
+class FailingDataset(Dataset):
+    def __len__(self):
+        return 4
+
+    def __getitem__(self, index):
+        if index == 2:
+            raise ValueError(index)
+        return torch.tensor(index)
+
+
+def test_prefetch_loader_break_then_full_epoch():
+    loader = make_loader(TensorDataset(torch.arange(20)), batch_size=2, num_workers=2, pin_memory=False,
+                         max_prefetch=2)
+    assert isinstance(loader, PrefetchLoader) and len(loader) == 10
+
+    for _ in loader:
+        break
+    # the next epoch starts over with the persistent workers
+    assert torch.cat([batch for batch, in loader]).tolist() == list(range(20))
+
+
+def test_prefetch_loader_raises_the_loader_error():
+    loader = make_loader(FailingDataset(), batch_size=1, num_workers=0, pin_memory=False)
+    with pytest.raises(ValueError):
+        list(loader)
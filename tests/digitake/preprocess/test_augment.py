@@ -0,0 +1,93 @@
+import numpy as np
+import torch
+import torchvision
+import torchvision.transforms as transforms
+from PIL import Image
+from torchvision.transforms.functional import InterpolationMode
+
+from src.digitake.preprocess import IMAGENET_MEAN, IMAGENET_STD, get_imagenet_mean_std, get_transform, \
+    imagenet_normalize, normalize_inplace
+from src.digitake.preprocess.augment import BatchNormalize, DecodeJPEG, RandomRotatedCrop
+
+
+def make_gradient_image(size=110):
+    x, y = np.meshgrid(np.arange(size), np.arange(size))
+    return Image.fromarray(np.stack([x * 2, y * 2, x + y], axis=2).astype(np.uint8))
+
+
+def test_random_rotated_crop_matches_rotation_and_center_crop():
+    image = make_gradient_image()
+    reference = transforms.Compose([
+        transforms.RandomRotation(45, interpolation=InterpolationMode.BILINEAR, expand=True),
+        transforms.CenterCrop(100)
+    ])
+    fused = RandomRotatedCrop(45, 100)
+
+    for seed in range(5):
+        # both draw the angle once from torch, so the same seed gives the same angle
+        torch.manual_seed(seed)
+        expected = np.asarray(reference(image), dtype=np.float32)
+        torch.manual_seed(seed)
+        actual = np.asarray(fused(image), dtype=np.float32)
+
+        assert actual.shape == expected.shape
+        # they differ only by the sub-pixel rounding of the expanded canvas center
+        diff = np.abs(actual - expected).mean()
+        assert diff < 3, f"seed {seed}: mean abs diff {diff}"
+
+
+def make_uint8_batch():
+    images = [make_gradient_image(16), make_gradient_image(16).transpose(Image.FLIP_LEFT_RIGHT)]
+    expected = torch.stack([imagenet_normalize(transforms.ToTensor()(image)) for image in images])
+    batch = torch.stack([transforms.PILToTensor()(image) for image in images])
+    return batch, expected
+
+
+def test_batch_normalize_matches_to_tensor_and_normalize():
+    batch, expected = make_uint8_batch()
+    normalize = BatchNormalize()
+
+    assert torch.allclose(normalize(batch), expected, atol=1e-6)
+
+    floats = batch.float().div(255)
+    original = floats.clone()
+    assert torch.allclose(normalize(floats), expected, atol=1e-6)
+    assert torch.equal(floats, original), "a float input must not be normalized in place"
+
+
+def test_batch_normalize_does_not_alias_the_constants():
+    normalize = BatchNormalize()
+    assert normalize.mean.data_ptr() != IMAGENET_MEAN.data_ptr()
+    assert normalize.std.data_ptr() != IMAGENET_STD.data_ptr()
+
+    normalize.mean.zero_()
+    assert IMAGENET_MEAN.flatten().tolist() == BatchNormalize().mean.flatten().tolist() != [0, 0, 0]
+
+
+def test_normalize_inplace():
+    batch, expected = make_uint8_batch()
+    floats = batch.float().div(255)
+
+    assert normalize_inplace(floats) is floats
+    assert torch.allclose(floats, expected, atol=1e-6)
+
+    assert get_imagenet_mean_std(floats.device) is get_imagenet_mean_std(floats.device)
+    assert normalize_inplace(batch.div(255), dtype=torch.float64).dtype == torch.float64
+
+
+def test_decode_jpeg_matches_the_cpu_pipe(tmp_path):
+    # fine stripes over a gradient, they alias badly when downscaled without antialiasing
+    x, y = np.meshgrid(np.arange(600), np.arange(500))
+    stripes = (x // 2 % 2) * 96
+    array = np.stack([x * 255 // 600, y * 255 // 500, stripes + 64], axis=2).astype(np.uint8)
+    path = str(tmp_path / 'image.jpg')
+    Image.fromarray(array).save(path, quality=95)
+
+    for phase in ('train', 'val'):
+        expected = get_transform(224, phase, on_gpu=True)(Image.open(path).convert('RGB')).float()
+        actual = DecodeJPEG(224, phase, device='cpu')([torchvision.io.read_file(path)])[0].float()
+
+        assert actual.shape == expected.shape
+        # only the rounding of the two JPEG decoders and resize kernels differ
+        diff = (actual - expected).abs().mean().item()
+        assert diff < 1, f"{phase}: mean abs diff {diff}"
@@ -0,0 +1,32 @@
+import glob
+import os
+
+from src.digitake.preprocess import find_files, build_dataset
+
+
+def make_files(directory, names):
+    for name in names:
+        (directory / name).write_bytes(b'')
+
+
+def test_find_files_matches_glob(tmp_path):
+    make_files(tmp_path, ['a.png', 'b.png', '.hidden.png', 'c.jpg', 'd.png.bak'])
+    (tmp_path / 'sub.png').mkdir()
+
+    for ext in ('*.png', '*.jpg', '*', 'a.*', '*.[pj]*'):
+        expected = sorted(glob.glob(os.path.join(str(tmp_path), ext)))
+        assert sorted(find_files(str(tmp_path), ext)) == expected, ext
+
+    assert find_files(str(tmp_path / 'missing'), '*.png') == []
+
+
+def test_build_dataset(tmp_path):
+    for label in ('benign', 'malignant'):
+        (tmp_path / label).mkdir()
+        make_files(tmp_path / label, ['1.png', '2.png', '.3.png', '4.jpg'])
+
+    datasets = build_dataset({'malignant': 'malignant', 'benign': ['benign']}, root=str(tmp_path))
+
+    assert list(datasets) == ['malignant', 'benign']
+    for label, files in datasets.items():
+        assert sorted(files) == [os.path.join(str(tmp_path), label, name) for name in ('1.png', '2.png')]
@@ -0,0 +1,166 @@
+import os
+
+import pytest
+import torch
+import torchvision.transforms as transforms
+from PIL import Image
+
+from src.digitake.preprocess import get_transform, precompute
+from src.digitake.preprocess.thyroid import ThyroidDataset, ThyroidBatch, thyroid_collate, precomputed_path
+
+
+def make_dataset(tmp_path, sizes):
+    dataset = {}
+    for label, size in sizes.items():
+        dataset[label] = []
+        for i in range(size):
+            path = str(tmp_path / f"{label}_{i}.png")
+            Image.new('RGB', (4, 4), (40 * i, 40 * len(dataset), 0)).save(path)
+            dataset[label].append(path)
+    return dataset
+
+
+def test_thyroid_dataset_index(tmp_path):
+    dataset = make_dataset(tmp_path, {'malignant': 3, 'benign': 2, 'empty': 0})
+    ds = ThyroidDataset('val', dataset, transform=lambda x: x, with_alpha_channel=False)
+
+    assert len(ds) == 5
+    # classes are sorted by label, so benign is class 0
+    _, class_index, extra = ds[1]
+    assert (class_index, extra['label'], extra['inclass_index']) == (0, 'benign', 1)
+    _, class_index, extra = ds[4]
+    assert (class_index, extra['label'], extra['inclass_index']) == (2, 'malignant', 2)
+    assert extra['path'] == dataset['malignant'][2]
+    assert ds.get_class_label(2) == 'malignant'
+
+
+def test_thyroid_dataset_index_out_of_range(tmp_path):
+    dataset = make_dataset(tmp_path, {'malignant': 1, 'benign': 1})
+    ds = ThyroidDataset('train', dataset, transform=lambda x: x, with_alpha_channel=False)
+
+    for index in (-1, 2):
+        with pytest.raises(IndexError):
+            ds[index]
+
+
+def test_thyroid_dataset_return_extra(tmp_path):
+    dataset = make_dataset(tmp_path, {'malignant': 1, 'benign': 1})
+
+    assert len(ThyroidDataset('train', dataset, transform=lambda x: x, with_alpha_channel=False)[1]) == 2
+    assert len(ThyroidDataset('val', dataset, transform=lambda x: x, with_alpha_channel=False)[1]) == 3
+    ds = ThyroidDataset('train', dataset, transform=lambda x: x, with_alpha_channel=False, return_extra=True)
+    assert ds[1][2]['label'] == 'malignant'
+
+
+def test_thyroid_dataset_cache_dir(tmp_path):
+    dataset = make_dataset(tmp_path, {'malignant': 1, 'benign': 1})
+    cache_dir = str(tmp_path / 'cache')
+    ds = ThyroidDataset('val', dataset, transform=get_transform(8, 'val'), with_alpha_channel=False,
+                        cache_dir=cache_dir)
+
+    image, _, _ = ds[0]
+    assert len(os.listdir(cache_dir)) == 1
+    # the second read must come from the cache, not from the changed file
+    Image.new('RGB', (4, 4), (255, 255, 255)).save(dataset['benign'][0])
+    cached, _, _ = ds[0]
+    assert torch.equal(cached, image)
+
+
+def test_thyroid_dataset_cache_dir_needs_a_stable_key(tmp_path):
+    dataset = make_dataset(tmp_path, {'malignant': 1, 'benign': 1})
+    cache_dir = str(tmp_path / 'cache')
+
+    for transform in (lambda x: x, transforms.Compose([transforms.Lambda(lambda x: x), transforms.ToTensor()])):
+        with pytest.raises(AssertionError):
+            ThyroidDataset('val', dataset, transform=transform, with_alpha_channel=False, cache_dir=cache_dir)
+        # an explicit cache_key identifies it instead
+        ThyroidDataset('val', dataset, transform=transform, with_alpha_channel=False, cache_dir=cache_dir,
+                       cache_key='identity')
+
+
+def test_thyroid_dataset_cache_dir_keys_the_precomputed_source(tmp_path):
+    dataset = make_dataset(tmp_path, {'malignant': 1, 'benign': 1})
+    precomputed_dir = tmp_path / 'precomputed'
+    precomputed_dir.mkdir()
+    Image.new('RGB', (8, 8)).save(precomputed_path(str(precomputed_dir), dataset['benign'][0], 8), 'WEBP')
+    cache_dir = str(tmp_path / 'cache')
+
+    ThyroidDataset('val', dataset, transform=get_transform(8, 'val'), with_alpha_channel=False,
+                   cache_dir=cache_dir)[0]
+    ThyroidDataset('val', dataset, transform=get_transform(8, 'val'), with_alpha_channel=False,
+                   cache_dir=cache_dir, precomputed_dir=str(precomputed_dir), precomputed_size=8)[0]
+    assert len(os.listdir(cache_dir)) == 2
+
+
+def test_thyroid_dataset_image_cache(tmp_path):
+    dataset = make_dataset(tmp_path, {'malignant': 2, 'benign': 1})
+    image_cache = ThyroidDataset.prepare_cache(dataset, str(tmp_path / 'cache.npy'), 8)
+
+    decoded = ThyroidDataset('val', dataset, transform=get_transform(8, 'val'), with_alpha_channel=False)
+    cached = ThyroidDataset('val', dataset, transform=get_transform(8, 'val'), with_alpha_channel=False,
+                            image_cache=image_cache)
+    for index in range(len(decoded)):
+        assert torch.equal(cached[index][0], decoded[index][0])
+
+
+def test_thyroid_dataset_image_cache_of_another_dataset(tmp_path):
+    dataset = make_dataset(tmp_path, {'malignant': 2, 'benign': 1})
+    image_cache = ThyroidDataset.prepare_cache(dataset, str(tmp_path / 'cache.npy'), 8)
+    ds = ThyroidDataset('val', dataset, transform=get_transform(8, 'val'), with_alpha_channel=False,
+                        image_cache=image_cache)
+
+    # reordered paths
+    with pytest.raises(AssertionError):
+        ds.set_dataset({'malignant': dataset['malignant'][::-1], 'benign': dataset['benign']})
+
+    # different paths with the same number of images per class
+    (tmp_path / 'other').mkdir()
+    with pytest.raises(AssertionError):
+        ds.set_dataset(make_dataset(tmp_path / 'other', {'malignant': 2, 'benign': 1}))
+
+
+def test_thyroid_dataset_precomputed_dir(tmp_path):
+    (tmp_path / 'data').mkdir()
+    dataset = make_dataset(tmp_path / 'data', {'malignant': 2, 'benign': 1})
+    out = str(tmp_path / 'precomputed')
+    # another form of the root than the dataset paths
+    precompute.main(['data', '--out', out, '--target-size', '8', '--root', str(tmp_path / 'data' / '..')])
+
+    ds = ThyroidDataset('val', dataset, transform=get_transform(8, 'val'), with_alpha_channel=False,
+                        precomputed_dir=out, precomputed_size=8)
+    for index, path in enumerate(dataset['benign'] + dataset['malignant']):
+        assert os.path.dirname(ds._sources[index]) == out
+        assert ds[index][2]['path'] == path
+
+    # images precomputed for another size are not used
+    with pytest.warns(UserWarning):
+        ds = ThyroidDataset('val', dataset, transform=get_transform(16, 'val'), with_alpha_channel=False,
+                            precomputed_dir=out, precomputed_size=16)
+    assert ds._sources == ds._paths
+
+
+def test_thyroid_collate():
+    images = [torch.zeros(3, 4, 4), torch.ones(3, 4, 4)]
+
+    batch = thyroid_collate([(images[0], 0), (images[1], 1)])
+    assert isinstance(batch, ThyroidBatch)
+    inputs, labels, extra = batch
+    assert inputs.shape == (2, 3, 4, 4) and labels.tolist() == [0, 1] and extra is None
+
+    extras = [{'path': 'a.png', 'class_index': 0}, {'path': 'b.png', 'class_index': 1}]
+    inputs, labels, extra = thyroid_collate([(images[0], 0, extras[0]), (images[1], 1, extras[1])])
+    assert extra['path'] == ['a.png', 'b.png'] and extra['class_index'].tolist() == [0, 1]
+
+    # encoded JPEGs(decode_on_gpu) of different lengths are kept as a list
+    encoded = [torch.zeros(5, dtype=torch.uint8), torch.zeros(7, dtype=torch.uint8)]
+    inputs, labels, extra = thyroid_collate([(encoded[0], 0), (encoded[1], 1)])
+    assert isinstance(inputs, list) and [len(x) for x in inputs] == [5, 7]
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="pin_memory needs CUDA")
+def test_thyroid_batch_pin_memory():
+    batch = thyroid_collate([(torch.zeros(3, 4, 4), 0), (torch.ones(3, 4, 4), 1)]).pin_memory()
+    assert batch.image.is_pinned() and batch.label.is_pinned()
+
+    batch = thyroid_collate([(torch.zeros(5, dtype=torch.uint8), 0), (torch.zeros(7, dtype=torch.uint8), 1)])
+    assert batch.pin_memory().label.is_pinned()